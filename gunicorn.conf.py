@@ -0,0 +1,8 @@
+# Gunicorn 配置，由 scripts/serve.sh 通过 --config 加载。
+
+
+def post_worker_init(worker):
+    """worker 加载应用并安装好自己的信号处理后，再启用状态快照"""
+    import server
+
+    server.setup_snapshot()
@@ -5,6 +5,7 @@ import sys
 import pyautogui
 import socketio
 import configparser
+from urllib.parse import urlencode
 from PySide6.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -83,9 +84,13 @@ class SocketIOThread(QThread):
     connection_error = Signal()
     connection_success = Signal()
 
-    def __init__(self, server_url):
+    def __init__(self, server_url, room, role, room_config):
         super().__init__()
         self.server_url = server_url
+        self.room = room
+        self.role = role
+        # register_host_client 的参数：可选的 roster / quorum
+        self.room_config = room_config
         self.sio = socketio.Client(logger=True, engineio_logger=True)
         self.setup_events()
 
@@ -93,7 +98,7 @@ class SocketIOThread(QThread):
         @self.sio.event
         def connect():
             print("成功连接到服务器！")
-            self.sio.emit("register_host_client")
+            self.sio.emit("register_host_client", self.room_config)
             self.connection_success.emit()
 
         @self.sio.event
@@ -116,7 +121,9 @@ class SocketIOThread(QThread):
 
     def run(self):
         try:
-            self.sio.connect(self.server_url, transports=["websocket"])
+            # 房间和角色通过连接参数传给服务器
+            query = urlencode({"room": self.room, "role": self.role})
+            self.sio.connect(f"{self.server_url}?{query}", transports=["websocket"])
             self.sio.wait()
         except socketio.exceptions.ConnectionError as e:
             print(f"无法连接到服务器: {e}")
@@ -124,7 +131,7 @@ class SocketIOThread(QThread):
 
     def send_ready(self):
         if self.sio.connected:
-            self.sio.emit("ready", {"player": "host"})
+            self.sio.emit("ready", {"player": self.role})
 
     def stop(self):
         if self.sio.connected:
@@ -146,9 +153,12 @@ class MainWindow(QMainWindow):
             self.server_url = self.config.get("Server", "url")
             self.set_pos_delay = self.config.getint("Settings", "set_pos_delay_ms")
             self.hotkey_name = self.config.get("Settings", "hotkey", fallback="RETURN")
+            self.room = self.config.get("Room", "room", fallback="default")
+            self.role = self.config.get("Room", "role", fallback="host")
+            self.room_config = self.load_room_config()
             self.update_hotkey_from_name(self.hotkey_name)
 
-        except (configparser.NoSectionError, configparser.NoOptionError) as e:
+        except (configparser.NoSectionError, configparser.NoOptionError, ValueError) as e:
             QMessageBox.critical(
                 self,
                 "配置错误",
@@ -173,13 +183,26 @@ class MainWindow(QMainWindow):
 
         self.action_completed.connect(self.on_action_finished)
 
-        self.socket_thread = SocketIOThread(self.server_url)
+        self.socket_thread = SocketIOThread(
+            self.server_url, self.room, self.role, self.room_config
+        )
         self.socket_thread.status_updated.connect(self.update_status_ui)
         self.socket_thread.proceed_click.connect(self.perform_action)
         self.socket_thread.connection_error.connect(self.show_connection_error)
         self.socket_thread.connection_success.connect(self.on_connection_success)
         self.socket_thread.start()
 
+    def load_room_config(self):
+        """读取可选的房间名单和法定人数，格式错误时抛出 ValueError"""
+        room_config = {}
+        roster = self.config.get("Room", "roster", fallback="").strip()
+        if roster:
+            room_config["roster"] = [p.strip() for p in roster.split(",") if p.strip()]
+        quorum = self.config.get("Room", "quorum", fallback="").strip().lower()
+        if quorum:
+            room_config["quorum"] = quorum if quorum == "all" else int(quorum)
+        return room_config
+
     def on_action_finished(self):
         if not self.socket_thread.sio.connected:
             self.ready_button.setEnabled(False)
@@ -453,12 +476,20 @@ class MainWindow(QMainWindow):
         self.set_hotkey_button.setDown(False)  # 立即弹起按钮
 
     def update_status_ui(self, state):
-        self.update_single_status(self.my_status_widget, state["host_ready"])
-        self.update_single_status(
-            self.opponent_status_widget, state["participant_ready"]
+        # 多人房间中，对方指示灯表示“其他玩家均已就绪”
+        roster = state.get("roster", ["host", "participant"])
+        others = [player for player in roster if player != self.role]
+        my_ready = state.get(f"{self.role}_ready", False)
+        others_ready = bool(others) and all(
+            state.get(f"{player}_ready", False) for player in others
+        )
+        self.update_single_status(self.my_status_widget, my_ready)
+        self.update_single_status(self.opponent_status_widget, others_ready)
+        self.opponent_status_widget.setToolTip(
+            f"就绪 {state.get('ready_count', 0)}/{state.get('required', len(roster))}"
         )
         if self.socket_thread.sio.connected:
-            self.ready_button.setEnabled(not state["host_ready"])
+            self.ready_button.setEnabled(self.role in roster and not my_ready)
 
     def update_single_status(self, widget, is_ready):
         indicator = widget.findChild(QLabel, "statusIndicator")
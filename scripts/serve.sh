@@ -6,6 +6,10 @@ BIND_HOST="0.0.0.0"
 DEFAULT_PORT="8080"
 WORKERS=1
 WORKER_CLASS="eventlet"
+# 优雅退出的等待秒数：旧 worker 写完状态快照后尽快退出，客户端随即重连到新 worker
+GRACEFUL_TIMEOUT=1
+# Gunicorn 配置文件，其中的 post_worker_init 钩子负责启用状态快照
+CONFIG_FILE="gunicorn.conf.py"
 
 # --- 参数处理 ---
 ACTION=$1
@@ -17,6 +21,7 @@ PORT=${2:-$DEFAULT_PORT}
 # 根据端口号生成唯一的 PID 和日志文件名，以支持多实例
 PID_FILE="gunicorn_${PORT}.pid"
 LOG_FILE="server_${PORT}.log" # 每个实例使用独立的日志文件
+SNAPSHOT_FILE="state_${PORT}.json" # 每个实例使用独立的状态快照
 # 组合成 Gunicorn 需要的绑定地址
 BIND_ADDR="${BIND_HOST}:${PORT}"
 
@@ -40,9 +45,12 @@ start() {
     fi
 
     echo "Starting Gunicorn on port ${PORT}..."
+    STATE_SNAPSHOT_PATH=${SNAPSHOT_FILE} \
     nohup gunicorn --pid ${PID_FILE} \
                    --worker-class ${WORKER_CLASS} \
                    -w ${WORKERS} \
+                   --graceful-timeout ${GRACEFUL_TIMEOUT} \
+                   --config ${CONFIG_FILE} \
                    --bind ${BIND_ADDR} \
                    ${APP_NAME} > ${LOG_FILE} 2>&1 &
 
@@ -62,7 +70,10 @@ start() {
 }
 
 # 停止服务
+# 传入 --keep-snapshot 时保留 worker 退出时写出的状态快照（仅供重启使用），
+# 否则视为真正的停止，删除快照，下次启动从空状态开始。
 stop() {
+    local keep_snapshot=$1
     echo "Attempting to stop Gunicorn on port ${PORT}..."
 
     # 使用 pgrep -f 来查找包含特定绑定地址的 gunicorn 进程
@@ -97,10 +108,36 @@ stop() {
     if [ -f "$PID_FILE" ]; then
         rm -f "$PID_FILE"
     fi
+
+    if [ "$keep_snapshot" != "--keep-snapshot" ] && [ -f "$SNAPSHOT_FILE" ]; then
+        echo "Removing state snapshot: ${SNAPSHOT_FILE}"
+        rm -f "$SNAPSHOT_FILE"
+    fi
     
     echo "Gunicorn on port ${PORT} stopped."
 }
 
+# 平滑重启：向 master 发送 SIGHUP，由 Gunicorn 先启动新 worker 再优雅关闭旧 worker。
+# 旧 worker 在 SIGTERM 时写出状态快照，新 worker 读取后客户端重连即可回到原房间。
+reload() {
+    if ! is_running || [ ! -f "$PID_FILE" ]; then
+        echo "Gunicorn is not running on port ${PORT}, starting a fresh instance..."
+        start
+        return
+    fi
+
+    MASTER_PID=$(cat "$PID_FILE")
+    echo "Reloading Gunicorn on port ${PORT} (master PID: ${MASTER_PID}) with graceful worker rotation..."
+    if kill -HUP "$MASTER_PID" > /dev/null 2>&1; then
+        echo "Workers are rotating. State snapshot: ${SNAPSHOT_FILE}"
+    else
+        echo "Failed to signal master ${MASTER_PID}. Falling back to a full restart..."
+        stop --keep-snapshot
+        sleep 1
+        start
+    fi
+}
+
 # 显示特定端口的服务状态
 status_port() {
     local target_port=$1
@@ -169,10 +206,7 @@ case "$ACTION" in
         ;;
     restart)
         echo "Restarting Gunicorn on port ${PORT}..."
-        stop
-        # 稍微等待一下，确保端口已释放
-        sleep 1
-        start
+        reload
         ;;
     status)
         # 如果提供了第二个参数 (端口号)，则显示特定端口的状态
@@ -193,6 +227,7 @@ case "$ACTION" in
         echo "  ./serve.sh start          # Start on default port ${DEFAULT_PORT}"
         echo "  ./serve.sh start 9000     # Start on port 9000"
         echo "  ./serve.sh stop 9000      # Stop the instance on port 9000"
+        echo "  ./serve.sh restart 9000   # Rotate workers on port 9000, keeping room state"
         echo "  ./serve.sh status         # Scan and list all running instances"
         echo "  ./serve.sh status 9000    # Show detailed status for port 9000"
         exit 1
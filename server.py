@@ -1,6 +1,10 @@
 from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
+import json
 import os
+import signal
+import sys
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,14 +13,356 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'c10a07fe5070c14fb1975fc9fe0398f65e367dc84d089160')
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# 状态快照：收到 SIGTERM 时写盘，启动时读回，使重启后客户端重连即可回到原房间
+SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', 'state_snapshot.json')
+# 超过该秒数的快照视为过期，不再恢复，避免很久之前的就绪状态突然生效
+SNAPSHOT_MAX_AGE = float(os.getenv('STATE_SNAPSHOT_MAX_AGE', '300'))
+# 恢复窗口（秒）：窗口内重新注册的执行者不会重置准备状态，
+# 窗口结束后仍未重连的临时角色被移出名单
+RESTORE_WINDOW = float(os.getenv('STATE_RESTORE_WINDOW', '30'))
+# 快照格式版本：修改 Room.to_snapshot 的结构时递增，旧格式的快照会被忽略
+SNAPSHOT_VERSION = 1
+
+DEFAULT_ROOM = 'default'
+DEFAULT_ROSTER = ('host', 'participant')
+
+
+class Room:
+    """
+    一个同步房间：任意数量的玩家（roster）、法定人数规则（quorum）和若干执行者。
+    准备状态用位图保存，每个玩家占一位；同时维护已就绪人数，
+    使每次准备事件的屏障检查都是 O(1)。
+
+    名单由两部分组成：执行者声明的常驻玩家，以及当前以某个角色连接的玩家。
+    后者在该角色最后一个连接断开时移出名单，释放的位留给新玩家复用。
+    默认房间只接受声明的玩家，访客无法改变其双人规则。
+    """
+
+    def __init__(self, room_id, roster=DEFAULT_ROSTER, quorum='all'):
+        self.room_id = room_id
+        self.open_roster = room_id != DEFAULT_ROOM  # 是否允许访客以新角色加入
+        self.roster = {}  # 玩家名 -> 位序号
+        self.free_bits = []  # 已离开玩家释放的位序号
+        self.declared = set()  # 常驻玩家，断线也保留
+        self.role_sids = {}  # 玩家名 -> 以该角色连接的 SID 集合
+        self.ready_mask = 0
+        self.ready_count = 0
+        self.quorum = 'all'
+        self.executors = set()  # 执行点击的桌面客户端 SID
+        self.members = set()  # 当前连接在本房间的所有 SID（含旁观者）
+        self.pending_executors = 0  # 从快照恢复后，预计还会重新注册的执行者数量
+        self.restore_deadline = None  # 恢复窗口的截止时间，None 表示不在恢复中
+        self.declare_roster(roster)
+        self.set_quorum(quorum)
+
+    @property
+    def executor_channel(self):
+        """所有执行者共同加入的 Socket.IO 房间，用于一次性扇出 proceed_click"""
+        return f'{self.room_id}/executors'
+
+    @property
+    def required(self):
+        """触发点击所需的就绪人数"""
+        if self.quorum == 'all':
+            return len(self.roster)
+        return min(self.quorum, len(self.roster))
+
+    def add_player(self, player):
+        if player not in self.roster:
+            self.roster[player] = self.free_bits.pop() if self.free_bits else len(self.roster)
+
+    def remove_player(self, player):
+        """移出玩家并清除其就绪位"""
+        index = self.roster.pop(player)
+        bit = 1 << index
+        if self.ready_mask & bit:
+            self.ready_mask &= ~bit
+            self.ready_count -= 1
+        self.free_bits.append(index)
+
+    def declare_roster(self, roster):
+        """用新的常驻名单替换旧的；不再声明且未连接的玩家被移出"""
+        for player in self.declared.difference(roster):
+            if player not in self.role_sids:
+                self.remove_player(player)
+        self.declared = set(roster)
+        for player in roster:
+            self.add_player(player)
+
+    def join(self, player, sid):
+        """以某个角色接入，返回该角色是否在名单中"""
+        if player not in self.roster:
+            if not self.open_roster:
+                return False
+            self.add_player(player)
+        self.role_sids.setdefault(player, set()).add(sid)
+        return True
+
+    def leave(self, player, sid):
+        """角色的最后一个连接离开时，未声明的玩家移出名单"""
+        sids = self.role_sids.get(player)
+        if sids is None:
+            return
+        sids.discard(sid)
+        if not sids:
+            del self.role_sids[player]
+            if player not in self.declared:
+                self.remove_player(player)
+
+    def set_quorum(self, quorum):
+        """设置法定人数：'all' 或正整数 k（k-of-n）"""
+        if quorum != 'all':
+            quorum = int(quorum)
+            if quorum < 1:
+                raise ValueError(f"quorum 必须为 'all' 或正整数，收到: {quorum}")
+        self.quorum = quorum
+
+    def mark_ready(self, player):
+        """标记玩家就绪，返回该玩家是否属于本房间"""
+        index = self.roster.get(player)
+        if index is None:
+            return False
+        bit = 1 << index
+        if not self.ready_mask & bit:
+            self.ready_mask |= bit
+            self.ready_count += 1
+        return True
+
+    def is_ready(self, player):
+        index = self.roster.get(player)
+        return index is not None and bool(self.ready_mask >> index & 1)
+
+    def barrier_reached(self):
+        return self.required > 0 and self.ready_count >= self.required
+
+    def reset(self):
+        """重置准备状态"""
+        self.ready_mask = 0
+        self.ready_count = 0
+
+    def to_snapshot(self):
+        """导出可持久化的部分；执行者和连接的SID在重启后失效，不保存"""
+        return [self.roster, sorted(self.declared), self.quorum, self.ready_mask, len(self.executors)]
+
+    @classmethod
+    def from_snapshot(cls, room_id, snapshot):
+        """从 to_snapshot 的结果重建房间，结构不符时抛出 ValueError"""
+        if not (isinstance(snapshot, list) and len(snapshot) == 5):
+            raise ValueError(f"房间 {room_id} 的快照结构无效")
+        roster, declared, quorum, ready_mask, executors = snapshot
+        if not (
+            isinstance(roster, dict)
+            and all(is_player_name(p) and is_count(i) for p, i in roster.items())
+            and len(set(roster.values())) == len(roster)
+            and isinstance(declared, list)
+            and all(is_player_name(p) for p in declared)
+            and is_count(ready_mask)
+            and is_count(executors)
+        ):
+            raise ValueError(f"房间 {room_id} 的快照字段无效")
+        room = cls(room_id, (), quorum)
+        # 按原位序号恢复名单，就绪位图因此可以原样沿用
+        room.roster = dict(roster)
+        used = set(room.roster.values())
+        room.free_bits = [index for index in range(max(used, default=-1) + 1) if index not in used]
+        room.declared = set(declared) & room.roster.keys()
+        room.ready_mask = ready_mask & sum(1 << index for index in used)
+        room.ready_count = room.ready_mask.bit_count()
+        room.pending_executors = executors
+        room.restore_deadline = time.time() + RESTORE_WINDOW
+        return room
+
+    def executor_returned(self):
+        """执行者重新注册时调用；属于恢复中预计回来的执行者时返回 True"""
+        if self.pending_executors > 0:
+            self.pending_executors -= 1
+            return True
+        return False
+
+    def is_idle(self):
+        """没有任何连接、执行者，也不在恢复窗口内时，房间可以被回收"""
+        restoring = self.restore_deadline is not None and time.time() < self.restore_deadline
+        return not self.members and not self.executors and not restoring
+
+    def settle(self):
+        """恢复窗口结束后，不再等待执行者，并移出未声明且未重连的角色"""
+        if self.restore_deadline is None or time.time() < self.restore_deadline:
+            return
+        self.restore_deadline = None
+        self.pending_executors = 0
+        for player in [p for p in self.roster if p not in self.declared and p not in self.role_sids]:
+            self.remove_player(player)
+
+    def state(self):
+        """生成下发给客户端的状态；保留 '<玩家>_ready' 键以兼容旧客户端"""
+        state = {f'{player}_ready': self.is_ready(player) for player in self.roster}
+        state.update(
+            roster=list(self.roster),
+            ready_count=self.ready_count,
+            required=self.required,
+        )
+        return state
+
+
+def is_player_name(name):
+    return isinstance(name, str) and bool(name)
+
+
+def is_count(value):
+    """非负整数（排除 bool）"""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
 # --- 状态管理 ---
-# desktop_host_sid: 存储桌面客户端的SID，它是动作的唯一执行者。
-# game_state: 存储当前一轮的准备状态。
-desktop_host_sid = None
-game_state = {
-    'host_ready': False,
-    'participant_ready': False,
-}
+# rooms: 房间ID -> Room，默认房间沿用原来的 host/participant 双人规则。
+# sid_rooms: 客户端SID -> 所在房间ID，用于断线时定位房间。
+# sid_roles: 客户端SID -> 连接时声明的角色，用于断线时释放名单位置。
+# shutting_down: 收到 SIGTERM 后置位，此后不再修改状态，保证快照即最终状态。
+rooms = {DEFAULT_ROOM: Room(DEFAULT_ROOM)}
+sid_rooms = {}
+sid_roles = {}
+shutting_down = False
+snapshot_enabled = False
+snapshot_loaded_at = 0.0
+
+
+def get_room(room_id):
+    """获取房间，不存在时按默认规则创建"""
+    room = rooms.get(room_id)
+    if room is None:
+        room = rooms[room_id] = Room(room_id)
+    room.settle()
+    return room
+
+
+def parse_room_config(data):
+    """校验 register_host_client 的参数，返回 (roster, quorum)，无效时抛出 ValueError"""
+    if data is None:
+        return None, None
+    if not isinstance(data, dict):
+        raise ValueError(f"参数必须为对象，收到: {type(data).__name__}")
+    roster = data.get('roster')
+    if roster is not None and not (isinstance(roster, list) and roster and all(is_player_name(p) for p in roster)):
+        raise ValueError(f"roster 必须为非空字符串列表，收到: {roster!r}")
+    quorum = data.get('quorum')
+    # 先校验全部参数再修改房间，保证无效配置不会被部分应用
+    valid_quorum = quorum is None or quorum == 'all' or (
+        isinstance(quorum, int) and not isinstance(quorum, bool) and quorum >= 1
+    )
+    if not valid_quorum:
+        raise ValueError(f"quorum 必须为 'all' 或正整数，收到: {quorum!r}")
+    return roster, quorum
+
+
+def broadcast_state(room):
+    emit('status_update', room.state(), to=room.room_id)
+
+
+def proceed_if_reached(room):
+    """达到法定人数时向所有执行者发送点击指令，并重置房间"""
+    if not room.barrier_reached():
+        return
+    print(f"房间 {room.room_id} 已达到法定人数，准备向桌面主程序发送点击指令...")
+
+    if room.executors:
+        # 所有执行者都在同一个频道里，一次 emit 即可扇出
+        emit('proceed_click', to=room.executor_channel)
+        print(f"指令已发送至 {len(room.executors)} 个桌面主程序")
+    else:
+        print("错误：桌面主程序未连接，无法发送点击指令！")
+
+    # 重置状态并广播
+    room.reset()
+    # 延迟一小下再广播重置状态，给点击事件留出执行时间，提升体验
+    socketio.sleep(0.1)
+    broadcast_state(room)
+    print("状态已重置")
+
+
+def save_snapshot():
+    """将所有房间状态原子地写入快照文件"""
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'saved_at': time.time(),
+        'rooms': {
+            room_id: room.to_snapshot()
+            for room_id, room in rooms.items()
+            if room_id == DEFAULT_ROOM or not room.is_idle()
+        },
+    }
+    tmp_path = f'{SNAPSHOT_PATH}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        print(f"状态快照已保存: {SNAPSHOT_PATH} ({len(rooms)} 个房间)")
+    except OSError as e:
+        print(f"错误：无法保存状态快照: {e}")
+
+
+def load_snapshot():
+    """
+    读取快照并替换当前房间状态。
+    只接受比上次读取更新、且未过期的快照；返回是否发生了恢复。
+    """
+    global rooms, snapshot_loaded_at
+    try:
+        with open(SNAPSHOT_PATH, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"版本不匹配，期望 {SNAPSHOT_VERSION}")
+        saved_at = snapshot['saved_at']
+        if not isinstance(saved_at, (int, float)) or not isinstance(snapshot['rooms'], dict):
+            raise ValueError("缺少 saved_at 或 rooms")
+        if saved_at <= snapshot_loaded_at or time.time() - saved_at > SNAPSHOT_MAX_AGE:
+            return False
+        restored = {
+            room_id: Room.from_snapshot(room_id, data)
+            for room_id, data in snapshot['rooms'].items()
+        }
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"错误：状态快照无效，已忽略: {e}")
+        return False
+    restored.setdefault(DEFAULT_ROOM, Room(DEFAULT_ROOM))
+    rooms = restored
+    snapshot_loaded_at = saved_at
+    print(f"已从快照恢复 {len(rooms)} 个房间: {SNAPSHOT_PATH}")
+    return True
+
+
+def install_snapshot_handler():
+    """
+    在 SIGTERM 时保存快照，然后交还给原有的处理函数。
+    Gunicorn 在加载应用前已安装自己的处理函数，这里与之串联以保留优雅退出。
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        global shutting_down
+        if not shutting_down:
+            shutting_down = True
+            save_snapshot()
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+
+def setup_snapshot():
+    """
+    启用状态快照：读取已有快照并安装 SIGTERM 处理函数。
+    只在服务入口调用（Gunicorn 的 post_worker_init 钩子或直接运行本文件），
+    单纯 import 本模块不会改动进程的信号处理或读取磁盘状态。
+    """
+    global snapshot_enabled
+    snapshot_enabled = True
+    load_snapshot()
+    install_snapshot_handler()
+
 
 @app.route('/')
 def index():
@@ -27,76 +373,128 @@ def index():
 def main():
     """为参与者提供主操作界面"""
     server_url = f"http://{request.host}"
-    # 从URL参数获取角色，默认为 'participant'
+    # 从URL参数获取角色和房间，默认为 'participant' 和默认房间
     role = request.args.get('role', 'participant')
-    print(f"为角色 {role} 生成客户端页面，服务器地址: {server_url}")
-    return render_template('main.html', server_url=server_url, role=role)
+    room_id = request.args.get('room', DEFAULT_ROOM)
+    # 快捷键与桌面客户端的默认热键 RETURN 保持一致（KeyboardEvent.key 名称）
+    hotkey = request.args.get('hotkey', 'Enter')
+    print(f"为角色 {role} 生成客户端页面，房间: {room_id}，服务器地址: {server_url}")
+    return render_template('main.html', server_url=server_url, role=role, room=room_id, hotkey=hotkey)
 
 @socketio.on('connect')
 def handle_connect():
-    print(f'客户端连接: sid={request.sid}')
+    sid = request.sid
+    # 平滑轮换时，新 worker 可能先于旧 worker 写出快照启动；
+    # 在还没有任何客户端接入前，如有更新的快照则重新读取
+    if snapshot_enabled and not sid_rooms:
+        load_snapshot()
+    # 房间和角色通过连接参数传入，旧客户端不带参数时进入默认房间
+    room = get_room(request.args.get('room', DEFAULT_ROOM))
+    role = request.args.get('role')
+    sid_rooms[sid] = room.room_id
+    room.members.add(sid)
+    if is_player_name(role):
+        if room.join(role, sid):
+            sid_roles[sid] = role
+        else:
+            print(f"角色 '{role}' 不在房间 {room.room_id} 的名单中，仅可旁观")
+    join_room(room.room_id)
+    print(f'客户端连接: sid={sid}, 房间={room.room_id}, 角色={role}')
     # 新客户端连接时，向其单独发送一次最新状态
-    emit('status_update', game_state)
+    emit('status_update', room.state())
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    global desktop_host_sid
     sid = request.sid
     print(f'客户端断开: sid={sid}')
+    room = rooms.get(sid_rooms.pop(sid, None))
+    role = sid_roles.pop(sid, None)
+    if shutting_down or room is None:
+        # 服务器正在重启，快照已保存，客户端会重连回原房间，不重置状态
+        return
+    room.members.discard(sid)
     # 如果断开的是桌面主程序，这是个严重问题
-    if sid == desktop_host_sid:
-        print("!!! 警告：桌面主程序已断开！重置所有状态。 !!!")
-        desktop_host_sid = None
-        # 因为主程序断了，游戏无法继续，重置准备状态
-        reset_game_state()
-        emit('status_update', game_state, broadcast=True)
+    if sid in room.executors:
+        room.executors.discard(sid)
+        if room.executors:
+            print(f"警告：房间 {room.room_id} 的一个执行者已断开，剩余 {len(room.executors)} 个。")
+        else:
+            print(f"!!! 警告：房间 {room.room_id} 的桌面主程序已全部断开！重置所有状态。 !!!")
+            # 因为主程序断了，游戏无法继续，重置准备状态
+            room.reset()
+            broadcast_state(room)
+    if role is not None:
+        room.leave(role, sid)
+        if role not in room.roster:
+            print(f"角色 '{role}' 已离开房间 {room.room_id}")
+            broadcast_state(room)
+            # 名单缩小后，剩余玩家可能已满足法定人数
+            proceed_if_reached(room)
+    # 最后一个连接离开后回收非默认房间，避免任意 ?room= 无限增加房间
+    if room.room_id != DEFAULT_ROOM and room.is_idle() and rooms.get(room.room_id) is room:
+        del rooms[room.room_id]
+        print(f"房间 {room.room_id} 已空闲，已回收")
 
 @socketio.on('register_host_client')
-def handle_register_host():
+def handle_register_host(data=None):
     """
     专门用于桌面客户端注册自己身份的事件。
+    可选参数 roster / quorum 用于配置房间的玩家名单和法定人数。
     """
-    global desktop_host_sid
-    desktop_host_sid = request.sid
-    print(f"桌面主程序已注册，SID: {desktop_host_sid}")
-    # 同时，如果桌面客户端重连，我们也重置游戏状态
-    reset_game_state()
-    emit('status_update', game_state, broadcast=True)
+    sid = request.sid
+    room = get_room(sid_rooms.get(sid, DEFAULT_ROOM))
+    try:
+        roster, quorum = parse_room_config(data)
+        if room.room_id == DEFAULT_ROOM and (roster is not None or quorum is not None):
+            # 默认房间固定为 host/participant 双人规则
+            raise ValueError("默认房间不可配置 roster / quorum")
+        if roster is not None:
+            room.declare_roster(roster)
+        if quorum is not None:
+            room.set_quorum(quorum)
+    except (TypeError, ValueError) as e:
+        print(f"错误：房间 {room.room_id} 配置无效，已忽略: {e}")
+    room.executors.add(sid)
+    join_room(room.executor_channel)
+    print(f"桌面主程序已注册，SID: {sid}，房间: {room.room_id}")
+    if room.executor_returned():
+        # 服务器重启后的重连：保留快照中的准备状态，直到所有执行者都回来
+        print(f"房间 {room.room_id} 的准备状态已从快照恢复，不重置 (还需等待 {room.pending_executors} 个执行者)")
+    else:
+        # 同时，如果桌面客户端重连，我们也重置游戏状态
+        room.reset()
+    broadcast_state(room)
+
+@socketio.on('ping_rtt')
+def handle_ping_rtt():
+    """客户端测量往返时延用，直接通过 ack 回应"""
+    return True
 
 @socketio.on('ready')
 def handle_ready(data):
-    """处理玩家的“准备就绪”事件"""
-    player = data.get('player')
-
-    if player == 'host':
-        game_state['host_ready'] = True
-        print(f"角色 'host' (α) 已就绪 (来自 SID: {request.sid})")
-    elif player == 'participant':
-        game_state['participant_ready'] = True
-        print(f"角色 'participant' (β) 已就绪 (来自 SID: {request.sid})")
-
-    emit('status_update', game_state, broadcast=True)
-
-    if game_state['host_ready'] and game_state['participant_ready']:
-        print("双方均已就绪，准备向桌面主程序发送点击指令...")
-        
-        if desktop_host_sid:
-            emit('proceed_click', to=desktop_host_sid)
-            print(f"指令已发送至桌面主程序 SID: {desktop_host_sid}")
-        else:
-            print("错误：桌面主程序未连接，无法发送点击指令！")
-        
-        # 重置状态并广播
-        reset_game_state()
-        # 延迟一小下再广播重置状态，给点击事件留出执行时间，提升体验
-        socketio.sleep(0.1) 
-        emit('status_update', game_state, broadcast=True)
-        print("状态已重置")
-
-def reset_game_state():
-    """重置准备状态"""
-    game_state['host_ready'] = False
-    game_state['participant_ready'] = False
+    """
+    处理玩家的“准备就绪”事件。
+    返回值作为 ack 发回客户端，网页端据此确认或回滚乐观更新。
+    """
+    player = data.get('player') if isinstance(data, dict) else None
+    room = get_room(sid_rooms.get(request.sid, DEFAULT_ROOM))
+
+    if shutting_down:
+        # 快照已写出，此后的变更会丢失，让客户端回滚并在重连后重试
+        print(f"服务器正在重启，拒绝角色 '{player}' 的准备事件")
+        return {'ok': False}
+
+    if not is_player_name(player) or not room.mark_ready(player):
+        print(f"未知角色 '{player}'，房间 {room.room_id} 忽略该事件 (来自 SID: {request.sid})")
+        return {'ok': False}
+    print(f"角色 '{player}' 已就绪 ({room.ready_count}/{room.required}, 来自 SID: {request.sid})")
+
+    broadcast_state(room)
+    proceed_if_reached(room)
+    return {'ok': True}
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    # debug 模式下由重载器的子进程提供服务，只在子进程中启用快照
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        setup_snapshot()
+    socketio.run(app, host='0.0.0.0', port=8080, debug=True)